@@ -1,47 +1,157 @@
-from collections.abc import Generator
+from collections.abc import Iterable
+from array import array
+from bisect import bisect_left
 from functools import cached_property
+from itertools import accumulate, groupby
 from datetime import datetime
-import re
 import math
+import string
 import struct
 from pathlib import Path
+from threading import Lock
 
 __all__ = ['nearmypostcode']
 
 # Useful globals and type aliases
-POSTCODE = re.compile('^[0-9A-Za-z ]+$')
 Point = tuple[float, float]
 Kilometers = float
-Headers = tuple[int, int, int, int]
+# Decoded bucket, parallel arrays of (keys, lats, longs)
+Bucket = tuple[array[int], array[int], array[int]]
+DEG_TO_RAD = math.pi / 180
 
-# Byte converters
-def uint32(b: bytes) -> Generator[int]:
-    # unsigned int
-    yield from (i[0] for i in struct.iter_unpack('I', b))
+# Packed codes fit in 24 bits, outward only entries are keyed above that so
+# they can't collide with a full postcode that packs to the same number
+OUTWARD_ONLY = 1 << 24
 
-def uint16(b: bytes) -> Generator[int]:
-    # unsigned short
-    yield from (i[0] for i in struct.iter_unpack('H', b))
+# Precompiled record field layouts (little endian)
+# Postcodes are 3 bytes but always followed by their lat/long, so they're read as a
+# u32 and masked down to 24 bits
+CODE = struct.Struct('<I')
+LATLONG = struct.Struct('<HH')
+DLATLONG = struct.Struct('<bb')
 
-def uint8(b: bytes) -> Generator[int]:
-    # unsigned char
-    yield from (i[0] for i in struct.iter_unpack('B', b))
+# Record formats, indexed by the format byte: (postcode delta, lat/long layout, outward only)
+# Stored postcode deltas are one less than the real delta, so a delta of 0 here
+# means the record holds an absolute postcode
+def _record_format(format: int) -> tuple[int, struct.Struct, bool]:
+    pc_is_delta = (format & 0x80) > 0
+    ll_is_delta = (format & 0x40) > 0
+    extra = format & 0x3f
+    pc_delta = extra + 1 if pc_is_delta else 0
+    # lat/long is a pair of signed 8 bit deltas, or a pair of absolute 16 bit unsigned numbers
+    ll_layout = DLATLONG if ll_is_delta else LATLONG
+    outward_only = not pc_is_delta and extra == 0x20
+    return (pc_delta, ll_layout, outward_only)
 
-def int16(b: bytes) -> Generator[int]:
-    # signed short
-    yield from (i[0] for i in struct.iter_unpack('h', b))
+FORMATS = tuple(_record_format(format) for format in range(256))
 
-def int8(b: bytes) -> Generator[int]:
-    # signed char
-    yield from (i[0] for i in struct.iter_unpack('b', b))
+# pack_code character encodings, indexed by ASCII value
+# (same values as the packer: A-Z => 0-25, 0-9 => 26-35, space => 36)
+INVALID = 0xff
+def _encoding_table(*ranges: tuple[str, int]) -> bytes:
+    table = bytearray([INVALID]*256)
+    for chars, first in ranges:
+        for i, char in enumerate(chars):
+            table[ord(char)] = first + i
+    return bytes(table)
 
-def float64(b: bytes) -> Generator[float]:
-    # double
-    yield from (i[0] for i in struct.iter_unpack('d', b))
+ENC_AZ = _encoding_table((string.ascii_uppercase, 0))
+ENC_09 = _encoding_table((string.digits, 0))
+ENC_AZ09 = _encoding_table((string.ascii_uppercase, 0), (string.digits, 26))
+ENC_AZ09_SPACE = _encoding_table((string.ascii_uppercase, 0), (string.digits, 26), (' ', 36))
+
+# Fixed layouts after the header (little endian, like the rest of the pack)
+# Bounding box extents (minlong, maxlong, minlat, maxlat)
+EXTENTS = struct.Struct('<4d')
+# The offset lookup table, 26*36 bucket offsets plus the end offset
+LUT = struct.Struct(f'<{26*36 + 1}I')
+
+# Running sum of values that restarts at every index listed in absolute
+# This turns the raw delta/absolute field values of a bucket back into absolute values
+def _undelta(values: list[int], absolute: list[int]) -> list[int]:
+    out: list[int] = []
+    bounds = [0, *absolute, len(values)]
+    for start, stop in zip(bounds, bounds[1:]):
+        out.extend(accumulate(values[start:stop]))
+    return out
+
+# Bucket decoder
+# Walks the delta packed records in buf[pos:end] and returns parallel (keys, lats, longs)
+# arrays sorted by key. Records are stored in postcode string order, which isn't the
+# order of their packed codes, so the sort is what makes the keys bisectable.
+def _decode(buf: memoryview, pos: int, end: int) -> Bucket:
+    # Raw field values as stored, the deltas get summed up after the walk so
+    # no record has to wait on the one before it
+    codes: list[int] = []
+    lats: list[int] = []
+    longs: list[int] = []
+    # Indices of records with an absolute postcode / lat-long, and outward only records
+    abs_codes: list[int] = []
+    abs_lls: list[int] = []
+    outward: list[int] = []
+    
+    # Bind everything the loop touches to locals, so each record is plain
+    # local lookups rather than global and attribute lookups
+    formats = FORMATS
+    unpack_code = CODE.unpack_from
+    latlong = LATLONG
+    add_code = codes.append
+    add_lat = lats.append
+    add_long = longs.append
+    
+    i = 0
+    while pos < end:
+        # Get the format of this postcode entry (each field delta encoded or not)
+        pc_delta, ll_layout, outward_only = formats[buf[pos]]
+        pos += 1
+        if pc_delta:
+            add_code(pc_delta)
+        else:
+            if outward_only:
+                outward.append(i)
+            add_code(unpack_code(buf, pos)[0] & 0xffffff)
+            pos += 3
+            abs_codes.append(i)
+        
+        lat, long = ll_layout.unpack_from(buf, pos)
+        pos += ll_layout.size
+        add_lat(lat)
+        add_long(long)
+        if ll_layout is latlong:
+            abs_lls.append(i)
+        i += 1
+    
+    # Each bucket starts from a zeroed state, so the first run sums from 0 too
+    keys = _undelta(codes, abs_codes)
+    lats = _undelta(lats, abs_lls)
+    longs = _undelta(longs, abs_lls)
+    for i in outward:
+        keys[i] |= OUTWARD_ONLY
+    
+    # sorted is stable, so duplicate keys keep file order like the linear scan did
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    return (
+        array('I', [keys[i] for i in order]),
+        array('H', [lats[i] for i in order]),
+        array('H', [longs[i] for i in order]),
+    )
+
+# The `a` term of the haversine formula for two latitudes and the longitude
+# difference between them, all in radians
+def _haversine_a(lat1_r: float, lat2_r: float, d_lon: float) -> float:
+    return (
+        math.sin((lat2_r - lat1_r) / 2)**2 + 
+        (
+            math.cos(lat1_r) * 
+            math.cos(lat2_r) * 
+            math.sin(d_lon / 2)**2
+        )
+    )
 
 class NearMyPostcode:
     __max_version__ = 2
     __magic__ = b'UKPP' # Use byte string for readability
+    __bucket_cache_size__ = 128 # Decoded LUT buckets kept for repeat lookups
     
     # Error mesages
     __e_format__ = "Postcode format not recognised"
@@ -50,9 +160,11 @@ class NearMyPostcode:
     
     def __init__(self, datafile_url: str | Path) -> None:
         self.url = datafile_url
-        self.deltapack = self._load_datafile(datafile_url)
+        # Keep the pack behind a memoryview so stripping the headers and extents
+        # doesn't copy the whole file each time
+        self.deltapack = memoryview(self._load_datafile(datafile_url))
         # Grab headers
-        self.headers = self.deltapack[:16]
+        self.headers = bytes(self.deltapack[:16])
         # Discard headers from pack
         self.deltapack = self.deltapack[16:]
         self._validate_version()
@@ -60,9 +172,43 @@ class NearMyPostcode:
         
         # Get the extents of the postcode bounding box
         # Moved from `lookup_postcode` method to initialization
-        self.minlong, self.maxlong, self.minlat, self.maxlat = float64(self.deltapack[0:32])
+        self.minlong, self.maxlong, self.minlat, self.maxlat = EXTENTS.unpack_from(self.deltapack)
         # Discard extents from pack
-        self.deltapack = self.deltapack[32:]
+        self.deltapack = self.deltapack[EXTENTS.size:]
+        
+        # Decode the offset lookup table once, entry i+1 is the end of bucket i
+        # LUT(3744), and offset(4)
+        self._datastart = LUT.size
+        self._lut = LUT.unpack_from(self.deltapack)
+        self._buckets: dict[int, Bucket] = {}
+        self._buckets_lock = Lock()
+        
+    def _decode_bucket(self, lut_index: int) -> Bucket:
+        # Decoded buckets are kept per instance, most recently used last
+        # (functools.lru_cache on a method would hold on to every instance)
+        # The lock covers the dict updates so threads sharing an instance can't
+        # evict the same bucket twice, the decode itself runs outside it
+        with self._buckets_lock:
+            bucket = self._buckets.pop(lut_index, None)
+            if bucket is not None:
+                self._buckets[lut_index] = bucket
+                return bucket
+        
+        startpos = self._lut[lut_index]
+        endpos = self._lut[lut_index+1]
+        
+        # Decode the file from startpos to endpos
+        # (startpos is relative to the start of the postcode data, so calculate that offset first)
+        bucket = _decode(self.deltapack, startpos + self._datastart, endpos + self._datastart)
+        
+        with self._buckets_lock:
+            # Another thread may have decoded the same bucket in the meantime
+            self._buckets.pop(lut_index, None)
+            while self._buckets and len(self._buckets) >= self.__bucket_cache_size__:
+                # Drop the least recently used bucket
+                del self._buckets[next(iter(self._buckets))]
+            self._buckets[lut_index] = bucket
+        return bucket
         
     def _load_datafile(self, datafile: str | Path) -> bytes:
         try:
@@ -88,149 +234,113 @@ class NearMyPostcode:
         return self.headers[0:4]
     @cached_property
     def version(self) -> int:
-        return next(uint32(self.headers[4:8]))
+        return int.from_bytes(self.headers[4:8], 'little')
     @cached_property
     def date(self) -> datetime:
-        return datetime.fromtimestamp(sum(uint32(self.headers[8:16])))
+        # u64 seconds since the unix epoch
+        return datetime.fromtimestamp(int.from_bytes(self.headers[8:16], 'little'))
 
     def pack_code(self, postcode: str) -> int:
-        def encode_AZ(x: str) -> int:
-            code = ord(x)
-            if code >= ord('A') and code <= ord('Z'):
-                return code - ord('A')
+        try:
+            raw = postcode.encode('ascii')
+        except UnicodeEncodeError:
+            raise ValueError(self.__e_format__) from None
+        if len(raw) not in (4, 7):
             raise ValueError(self.__e_format__)
-            
-        def encode_09(x: str) -> int:
-            code = ord(x)
-            if code >= ord('0') and code <= ord('9'):
-                return code - ord('0')
+        # The two character prefix isn't part of the code, it picks the LUT bucket,
+        # but it still has to be a letter then a letter or digit like the packer expects
+        if INVALID in (ENC_AZ[raw[0]], ENC_AZ09[raw[1]]):
             raise ValueError(self.__e_format__)
         
-        def encode_AZ09(x: str) -> int:
-            try:
-                return encode_AZ(x)
-            except ValueError:
-                return encode_09(x)
-                
-        def encode_AZ09_space(x: str) -> int:
-            if x == ' ':
-                return ord(' ')
-            return encode_AZ09(x)
-        
-        if len(postcode) == 4:
-            _,_,c,d = postcode
+        if len(raw) == 4:
             # Encode the rest
-            c2 = 37*encode_AZ09_space(c)
-            d2 = encode_AZ09_space(d)
-
-            encoded = c2 + d2
-            return encoded
+            c = ENC_AZ09_SPACE[raw[2]]
+            d = ENC_AZ09_SPACE[raw[3]]
+            if INVALID in (c, d):
+                raise ValueError(self.__e_format__)
+            return 37*c + d
         
-        if len(postcode) == 7:
-            _,_,c,d,e,f,g = postcode
-            c2 = 26*26*10*37*encode_AZ09_space(c)
-            d2 = 26*26*10*encode_AZ09_space(d)
-            e2 = 26*26*encode_09(e)
-            f2 = 26*encode_AZ(f)
-            g2 = encode_AZ(g)
-            encoded = c2 + d2 + e2 + f2 + g2
-            return encoded
-        raise ValueError(self.__e_format__)
+        c = ENC_AZ09_SPACE[raw[2]]
+        d = ENC_AZ09_SPACE[raw[3]]
+        e = ENC_09[raw[4]]
+        f = ENC_AZ[raw[5]]
+        g = ENC_AZ[raw[6]]
+        if INVALID in (c, d, e, f, g):
+            raise ValueError(self.__e_format__)
+        return 26*26*10*37*c + 26*26*10*d + 26*26*e + 26*f + g
     
     def format_postcode(self, postcode: str) -> str:
-        if not POSTCODE.fullmatch(postcode):
+        # The canonical postcode is 7 characters, the outward code (2 to 4 characters)
+        # left aligned and the inward code (always 3 characters) right aligned.
+        # Outward only codes are just padded to 4 characters
+        # Only ASCII letters, digits and spaces are allowed
+        code = postcode.replace(' ', '')
+        if not (code.isascii() and code.isalnum()):
             raise ValueError(self.__e_format__)
-        numchars = len(postcode)
+        code = code.upper()
+        numchars = len(code)
         
         if numchars > 7 or numchars < 2:
             raise ValueError(self.__e_format__)
-        if numchars <=4:
-            return f'{postcode:<4}'
-        inward = postcode[numchars-3:]
-        outward = postcode[:numchars-3]
-        return f'{outward:<4}{inward}'
+        if numchars <= 4:
+            return code.ljust(4)
+        return code[:-3].ljust(4) + code[-3:]
     
-    # NOTE: There is something wrong with my ported logic that isn't properly 
-    # indexing into the postcode tables
     def lookup_postcode(self, postcode: str) -> tuple[str, Point]:
+        cpostcode, lut_index, key = self._query(postcode)
+        return (cpostcode, self._locate(self._decode_bucket(lut_index), key))
+    
+    def lookup_postcodes(self, postcodes: Iterable[str]) -> list[tuple[str, Point] | None]:
+        # Same as lookup_postcode for each postcode, results are in the same order.
+        # A postcode that can't be looked up (bad format, not found, or not supported
+        # by the data file) gives None in its place instead of failing the whole batch,
+        # lookup_postcode on that postcode will raise the reason.
+        # Queries are grouped by LUT bucket so each bucket is fetched once per batch
+        queries: list[tuple[str, int, int] | None] = []
+        for postcode in postcodes:
+            try:
+                queries.append(self._query(postcode))
+            except ValueError:
+                queries.append(None)
+        results: list[tuple[str, Point] | None] = [None] * len(queries)
+        valid = {i: query for i, query in enumerate(queries) if query is not None}
+        by_bucket = sorted(valid, key=lambda i: valid[i][1])
+        for lut_index, group in groupby(by_bucket, key=lambda i: valid[i][1]):
+            bucket = self._decode_bucket(lut_index)
+            for i in group:
+                cpostcode, _, key = valid[i]
+                try:
+                    results[i] = (cpostcode, self._locate(bucket, key))
+                except ValueError:
+                    pass
+        return results
+    
+    def _query(self, postcode: str) -> tuple[str, int, int]:
         # Calculate the encoded value of this postcode
         cpostcode = self.format_postcode(postcode)
         lookup_outward_only = len(cpostcode) == 4
         if lookup_outward_only and self.version < 2:
             raise ValueError(self.__e_data_version__)
         c_code = self.pack_code(cpostcode) 
-        c = [ # type: ignore (Not Used?)
-            c_code & 0xff,
-            (c_code >> 8) & 0xff,
-            (c_code >> 16) & 0xff,
-        ]
-        
-        # Extent getting moved to __init__
-        # NOTE: This removes the extent data from the offset
+        key = c_code | OUTWARD_ONLY if lookup_outward_only else c_code
         
         # Use the two character prefix to find the offsets in the offset lookup table
         c1 = ord(cpostcode[0])
         c2 = ord(cpostcode[1])
         c2_i = (c2 - ord('0')) if c2 < ord('A') else (10 + c2 - ord('A'))
         lut_index = ((c1 - ord('A'))*36)+c2_i
-        print(lut_index)
-        lpos = (lut_index * 4)
-        startpos, endpos = uint32(self.deltapack[lpos:lpos+8])
-        
-        # Scan the rest of the file from startpos to endpos looking for the postcode
-        # (startpos is relative to the start of the postcode data, so calculate that offset first)
-        
-        # LUT(3744), and offset(4)
-        datastart = (4*26*36) + 4
-        pos = startpos + datastart
-        last_code = 0
-        last_lat = 0
-        last_long = 0
-        
-        while pos < (endpos + datastart):
-            is_outward_only = False
-            # Get the format of this postcode entry (each field delta encoded or not)
-            format = next(uint8(self.deltapack[pos:pos+1]))
-            pos += 1
-            pc_is_delta = (format & 0x80) > 0
-            ll_is_delta = (format & 0x40) > 0
-            # Calculate the postcode and lat/long by addition of the delta value or from absolute values
-            # as specified in the format byte
-            if pc_is_delta:
-                # Postcode delta encoding is part of the format byte
-                delta = format & 0x3f
-                this_code = last_code + delta + 1
-            else:
-                special = format & 0x3f
-                if special == 0x20:
-                    is_outward_only = True
-                    nc_a, nc_b, nc_c = uint8(self.deltapack[pos:pos+3])
-                    pos += 3
-                    this_code = (nc_c << 16) + (nc_b << 8) + nc_a
-                else:
-                    nc_a, nc_b, nc_c = uint8(self.deltapack[pos:pos+3])
-                    pos += 3
-                    this_code = (nc_c << 16) + (nc_b << 8) + nc_a
-            
-            if ll_is_delta:
-                # lat/long is delta encoded as a pair of signed 8 bit numbers
-                dlat, dlong = int8(self.deltapack[pos:pos+2])
-                pos += 2
-                long = last_long + dlong
-                lat = last_lat + dlat
-            else:
-                # Absolute lat/long is a pair of 16 bit unsigned numbers
-                lat, long = uint16(self.deltapack[pos:pos+4])
-                pos += 4
-            if is_outward_only == lookup_outward_only:
-                if this_code == c_code:
-                    # Calculate the real coordinates (the stored value is the fraction of the width or height of the bounding box)
-                    lat2  = self.minlat +  (self.maxlat -self.minlat )*(lat/65535.0)
-                    long2 = self.minlong + (self.maxlong-self.minlong)*(long/65535.0)
-                    return (cpostcode, (long2,lat2))
-            last_code = this_code
-            last_lat = lat
-            last_long = long
+        return (cpostcode, lut_index, key)
+    
+    def _locate(self, bucket: Bucket, key: int) -> Point:
+        keys, lats, longs = bucket
+        i = bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            lat = lats[i]
+            long = longs[i]
+            # Calculate the real coordinates (the stored value is the fraction of the width or height of the bounding box)
+            lat2  = self.minlat +  (self.maxlat -self.minlat )*(lat/65535.0)
+            long2 = self.minlong + (self.maxlong-self.minlong)*(long/65535.0)
+            return (long2,lat2)
 
         raise ValueError(self.__e_notfound__)
         
@@ -238,26 +348,25 @@ class NearMyPostcode:
         # https://en.wikipedia.org/wiki/Geographical_distance
         # This is an approximation of the geodesic distance b/w 
         # two points
-        lat1, lon1 = point_a
-        lat2, lon2 = point_b
+        # Points are [lon, lat], the same as lookup_postcode returns and the JS version takes
+        # (this used to read them as [lat, lon])
+        lon1, lat1 = point_a
+        lon2, lat2 = point_b
         earth_radius_km = 6371
-        d_lat = math.radians(lat2 - lat1)
-        d_lon = math.radians(lon2 - lon1)
-        a = (
-            math.sin(d_lat / 2)**2 + 
-            (
-                math.cos(math.radians(lat1)) * 
-                math.cos(math.radians(lat2)) * 
-                math.sin(d_lon / 2)**2
-            )
-        )
+        a = _haversine_a(lat1 * DEG_TO_RAD, lat2 * DEG_TO_RAD, (lon2 - lon1) * DEG_TO_RAD)
         c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
         return earth_radius_km * c
     
     def sort_by_distance(self, points: list[Point], point: Point) -> list[Point]:
         if len(point) != 2 and not isinstance(point, tuple | list): # type: ignore
             raise ValueError('point should be a pair of numbers: [lon, lat]')
-        return sorted(points, key=lambda i: self.distance_between(i, point))
+        # The haversine distance only grows with `a`, so that's enough to sort on
+        lon2, lat2 = point
+        lat2_r = lat2 * DEG_TO_RAD
+        def key(i: Point) -> float:
+            lon1, lat1 = i
+            return _haversine_a(lat1 * DEG_TO_RAD, lat2_r, (lon2 - lon1) * DEG_TO_RAD)
+        return sorted(points, key=key)
      
 def nearmypostcode(datafile_url: str | Path, quiet: bool=False) -> NearMyPostcode:
     nmp = NearMyPostcode(datafile_url)
@@ -0,0 +1,236 @@
+from datetime import datetime
+from pathlib import Path
+from string import ascii_uppercase, digits
+import struct
+import tempfile
+import unittest
+
+from nearmypostcode import NearMyPostcode, OUTWARD_ONLY, _undelta
+
+TESTDATA = Path(__file__).parent.parent / 'testdata'
+V1_PACK = TESTDATA / 'version=1' / 'A0AA0AA=(0,0).pack'
+
+def ref_key(postcode: str) -> int:
+    # Packed code of a canonical postcode, worked out the way src/main.rs does
+    # (A-Z => 0-25, 0-9 => 26-35, space => 36), with outward only codes keyed above 24 bits
+    def enc(char: str) -> int:
+        return 36 if char == ' ' else (ascii_uppercase + digits).index(char)
+    c, d = enc(postcode[2]), enc(postcode[3])
+    if len(postcode) == 4:
+        return (37*c + d) | OUTWARD_ONLY
+    e, f, g = int(postcode[4]), enc(postcode[5]), enc(postcode[6])
+    return 26*26*10*37*c + 26*26*10*d + 26*26*e + 26*f + g
+
+def build_pack(entries: list[tuple[str, int, int]], version: int = 2) -> tuple[bytes, list[int]]:
+    # Packs (postcode, lat, long) entries like src/main.rs: records in postcode string
+    # order, delta encoded where they fit, and every LUT bucket starting from zero.
+    # The extents are (0, 65535) both ways, so coordinates come out as the raw values.
+    # Returns the pack and the format byte of every record
+    data = bytearray()
+    formats: list[int] = []
+    starts: dict[str, int] = {}
+    for postcode, lat, long in sorted(entries, key=lambda entry: entry[0].ljust(7)):
+        if postcode[:2] not in starts:
+            starts[postcode[:2]] = len(data)
+            last_code = last_lat = last_long = 0
+        outward_only = len(postcode) == 4
+        code = ref_key(postcode) & ~OUTWARD_ONLY
+        pc_delta = not outward_only and 1 <= code - last_code <= 64
+        ll_delta = not outward_only and -128 <= lat - last_lat <= 127 and -128 <= long - last_long <= 127
+        format = (0x80 + code - last_code - 1 if pc_delta else 0x20 if outward_only else 0) | (0x40 if ll_delta else 0)
+        formats.append(format)
+        data.append(format)
+        if not pc_delta:
+            data += code.to_bytes(3, 'little')
+        if ll_delta:
+            data += struct.pack('<bb', lat - last_lat, long - last_long)
+        else:
+            data += struct.pack('<HH', lat, long)
+        last_code, last_lat, last_long = code, lat, long
+    
+    # Empty buckets start (and end) where the next bucket starts
+    lut = [len(data)]
+    for prefix in reversed([a + b for a in ascii_uppercase for b in digits + ascii_uppercase]):
+        lut.append(starts.get(prefix, lut[-1]))
+    lut.reverse()
+    return (
+        b'UKPP' + struct.pack('<IQ', version, 0) + struct.pack('<4d', 0, 65535, 0, 65535)
+        + struct.pack(f'<{len(lut)}I', *lut) + data,
+        formats,
+    )
+
+# (postcode, lat, long) records covering every record format, listed in pack order
+FIXTURE = [
+    # A0 bucket, an outward only code that packs to the same number as a full postcode
+    ('A0AA', 40000, 40000),    # outward only
+    ('A0AA0AA', 0, 0),         # absolute postcode and lat/long
+    # A1 bucket
+    ('A1  1AA', 100, 200),     # absolute postcode and lat/long
+    ('A1  1AB', 110, 190),     # delta postcode and lat/long
+    # AB bucket. Space and digits sort below letters as strings but encode above
+    # them, so the packed codes in here are out of order
+    ('AB1 ', 1000, 1000),      # outward only
+    ('AB1 1AA', 1010, 990),    # absolute postcode, delta lat/long
+    ('AB1 1AB', 1015, 985),    # delta postcode and lat/long
+    ('AB1 1AD', 1020, 980),    # delta postcode (+2) and lat/long
+    ('AB1 1AE', 30000, 30000), # delta postcode, absolute lat/long
+    ('AB101AA', 30005, 29990), # absolute postcode, delta lat/long
+    ('AB101AB', 30010, 29980), # delta postcode and lat/long
+    ('AB1A1AA', 500, 60000),   # absolute postcode and lat/long
+    # ZZ bucket, the last one in the LUT
+    ('ZZ9Z9ZZ', 65535, 0),     # absolute postcode and lat/long
+]
+FIXTURE_PACK, FIXTURE_FORMATS = build_pack(FIXTURE)
+
+class TestNearMyPostcode(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+        self.nmp = NearMyPostcode(V1_PACK)
+        self.fixture = self.load(FIXTURE_PACK)
+
+    def load(self, data: bytes) -> NearMyPostcode:
+        path = self.tmp / 'test.pack'
+        path.write_bytes(data)
+        return NearMyPostcode(path)
+
+    def test_load(self) -> None:
+        self.assertEqual(1, self.nmp.version)
+        self.assertEqual(
+            (0.0, 1.0, 0.0, 1.0),
+            (self.nmp.minlong, self.nmp.maxlong, self.nmp.minlat, self.nmp.maxlat),
+        )
+
+    def test_headers(self) -> None:
+        self.assertEqual(datetime.fromtimestamp(0), self.nmp.date)
+        # The date is a u64, not two u32 halves
+        data = bytearray(V1_PACK.read_bytes())
+        struct.pack_into('<Q', data, 8, 2**32 + 5)
+        self.assertEqual(datetime.fromtimestamp(2**32 + 5), self.load(data).date)
+
+    def test_format_postcode(self) -> None:
+        # Outward-only codes
+        self.assertEqual('SW1A', self.nmp.format_postcode('sw1a'))
+        self.assertEqual('CB1 ', self.nmp.format_postcode('cb 1'))
+        self.assertEqual('B1  ', self.nmp.format_postcode(' b 1'))
+        # Full postcodes
+        self.assertEqual('SW1A2AA', self.nmp.format_postcode('sw1a 2aa'))
+        self.assertEqual('CB2 3DS', self.nmp.format_postcode('cb23ds '))
+        # Valid but non-existing postcodes
+        self.assertEqual('ZZ9Z9ZZ', self.nmp.format_postcode('zz 9z9z  z'))
+        # Invalid postcodes should raise error
+        for postcode in ('ABCD1234', 'ab12_345', 'A', 'AB1é2AA', 'AB1²2AA'):
+            with self.assertRaisesRegex(ValueError, NearMyPostcode.__e_format__):
+                self.nmp.format_postcode(postcode)
+
+    def test_pack_code(self) -> None:
+        # Same encoding as the packer, A-Z => 0-25, 0-9 => 26-35, space => 36
+        self.assertEqual(37*27 + 36, self.nmp.pack_code('CB1 '))
+        self.assertEqual(26*26*10*37*27 + 26*26*2, self.nmp.pack_code('SW1A2AA'))
+        # The prefix has to be a letter then a letter or digit
+        for postcode in ('05 0BP', '0A  ', 'A 1 1AA'):
+            with self.assertRaisesRegex(ValueError, NearMyPostcode.__e_format__):
+                self.nmp.pack_code(postcode)
+
+    def test_decode_bucket(self) -> None:
+        # The fixture has every record format, and postcode deltas above 1
+        self.assertEqual(
+            {0x00, 0x20, 0x40, 0x80, 0xc0},
+            {format if format == 0x20 else format & 0xc0 for format in FIXTURE_FORMATS},
+        )
+        self.assertIn(0xc1, FIXTURE_FORMATS)
+        # Each bucket decodes to its records sorted by key, whatever order they were packed in
+        for prefix, lut_index in (('A0', 0), ('A1', 1), ('AB', 11), ('ZZ', 26*36 - 1)):
+            bucket = self.fixture._decode_bucket(lut_index)
+            self.assertEqual(['I', 'H', 'H'], [values.typecode for values in bucket])
+            self.assertEqual(
+                sorted((ref_key(postcode), lat, long) for postcode, lat, long in FIXTURE if postcode[:2] == prefix),
+                list(zip(*bucket)),
+            )
+
+    def test_undelta(self) -> None:
+        # Runs are summed from the last absolute value, or from 0 before the first one
+        self.assertEqual([2, 3, 5, 100, 98, 99, 7], _undelta([2, 1, 2, 100, -2, 1, 7], [3, 6]))
+        self.assertEqual([5, 6, 7], _undelta([5, 1, 1], [0]))
+        self.assertEqual([], _undelta([], []))
+
+    def test_lookup_postcode(self) -> None:
+        self.assertEqual(('A0AA0AA', (0.0, 0.0)), self.nmp.lookup_postcode('a0a a0aa'))
+        with self.assertRaisesRegex(ValueError, NearMyPostcode.__e_notfound__):
+            self.nmp.lookup_postcode('A0AA0AB')
+        with self.assertRaisesRegex(ValueError, NearMyPostcode.__e_format__):
+            self.nmp.lookup_postcode('05 0BP')
+
+    def test_lookup_fixture(self) -> None:
+        for postcode, lat, long in FIXTURE:
+            for query in (postcode, postcode.lower().replace(' ', '')):
+                cpostcode, (long2, lat2) = self.fixture.lookup_postcode(query)
+                self.assertEqual(postcode, cpostcode)
+                self.assertAlmostEqual(long, long2, places=6)
+                self.assertAlmostEqual(lat, lat2, places=6)
+        # Between two delta records
+        with self.assertRaisesRegex(ValueError, NearMyPostcode.__e_notfound__):
+            self.fixture.lookup_postcode('AB1 1AC')
+
+    def test_lookup_outward_only(self) -> None:
+        # Version 1 files cannot be used to lookup outward-only codes
+        with self.assertRaisesRegex(ValueError, NearMyPostcode.__e_data_version__):
+            self.nmp.lookup_postcode('A1')
+
+    def test_lookup_postcodes(self) -> None:
+        postcodes = ['AB1 1AD', 'AB1 1AC', '05 0BP', 'A0AA', 'ZZ9Z9ZZ', 'A0AA0AA', 'AB101AB']
+        found = {'AB1 1AD', 'A0AA', 'ZZ9Z9ZZ', 'A0AA0AA', 'AB101AB'}
+        self.assertEqual(
+            [self.fixture.lookup_postcode(postcode) if postcode in found else None for postcode in postcodes],
+            self.fixture.lookup_postcodes(postcodes),
+        )
+        # A postcode the data file can't look up doesn't fail the rest of the batch
+        self.assertEqual(
+            [None, ('A0AA0AA', (0.0, 0.0))],
+            self.nmp.lookup_postcodes(['A0AA', 'A0AA0AA']),
+        )
+
+    def test_bucket_cache(self) -> None:
+        self.fixture.__bucket_cache_size__ = 2
+        a1 = self.fixture._decode_bucket(1)
+        self.fixture._decode_bucket(11)
+        # A hit hands back the cached bucket and makes it the most recently used
+        self.assertIs(a1, self.fixture._decode_bucket(1))
+        self.fixture._decode_bucket(26*36 - 1)
+        self.assertEqual([1, 26*36 - 1], list(self.fixture._buckets))
+        # Decoding an evicted bucket again drops the least recently used one
+        self.fixture._decode_bucket(11)
+        self.assertEqual([26*36 - 1, 11], list(self.fixture._buckets))
+
+    def test_rejects_bad_files(self) -> None:
+        for path in (TESTDATA / 'invalid.pack', TESTDATA / 'version=999999' / 'A0AA0AA=(0,0).pack'):
+            with self.assertRaises(ValueError):
+                NearMyPostcode(path)
+
+    def test_distance_between(self) -> None:
+        # Points are [lon, lat]
+        dist = self.nmp.distance_between(
+            (0.14143769251545102, 52.19525652785534),
+            (0.12311532175173667, 52.20324411238269),
+        )
+        self.assertAlmostEqual(1.53, dist, delta=1.53*0.05)
+
+    def test_sort_by_distance(self) -> None:
+        # Rough town centres, named in order of distance from SW1A
+        towns = {
+            'D': (-1.47, 53.38), # Sheffield
+            'A': (-0.34, 51.75), # St Albans
+            'H': (-4.22, 57.48), # Inverness
+            'C': (-1.13, 52.63), # Leicester
+            'F': (-1.55, 54.52), # Darlington
+            'B': ( 0.12, 52.20), # Cambridge
+            'G': (-4.25, 55.86), # Glasgow
+            'E': (-2.48, 53.75), # Blackburn
+        }
+        by_point = {point: name for name, point in towns.items()}
+        sorted_points = self.nmp.sort_by_distance(list(towns.values()), (-0.13, 51.50))
+        self.assertEqual(list('ABCDEFGH'), [by_point[point] for point in sorted_points])
+
+if __name__ == '__main__':
+    unittest.main()